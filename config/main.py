@@ -7,4 +7,42 @@ def account_config():
     # 沙箱模式(1为开启，其他的为关闭)
     sandbox = 0
     
-    return appid, secret, sandbox
\ No newline at end of file
+    return appid, secret, sandbox
+
+def render_config():
+    # 回复渲染预算(超出后停止渲染并截断回复)
+    # 单条回复最大字数
+    max_output = 4000
+    # 单条回复最多执行的函数次数
+    max_expansions = 200
+    # 回调最大嵌套层数
+    max_callback_depth = 5
+    # 单条回复最长渲染时间(秒)
+    time_limit = 3
+
+    return max_output, max_expansions, max_callback_depth, time_limit
+
+def accounts_config():
+    # 多账号配置(同一进程运行，共用一份词库)
+    # 留空则使用account_config中的账号
+    # words为该账号使用的词库文件名，不填则使用全部词库
+    accounts = [
+        # {"appid": " ", "secret": " ", "sandbox": 0, "words": ["示例词库.liq"]},
+    ]
+
+    return accounts
+
+def profile_config():
+    # 性能分析配置
+    # 管理员指令: "性能分析 [消息条数] [秒数]"开始，"性能分析 停止"结束，也可以发送SIGUSR1信号开始
+    command = "性能分析"
+    # 可以使用指令的管理员id(即%id%)
+    admins = []
+    # 默认采样消息条数
+    max_messages = 100
+    # 默认采样时长(秒)
+    max_seconds = 60
+    # 结果输出目录
+    output_dir = "profiles"
+
+    return command, admins, max_messages, max_seconds, output_dir
@@ -8,9 +8,12 @@ import time
 import threading
 import random
 import re
+import signal
+import cProfile
+import pstats
 from collections import defaultdict
 from concurrent.futures import ThreadPoolExecutor
-from config.main import account_config
+from config.main import account_config, accounts_config, render_config, profile_config
 from botpy.types.message import Ark, ArkKv
 from botpy.types.message import MarkdownPayload, MessageMarkdownParams
 from botpy.message import GroupMessage, Message, DirectMessage
@@ -209,7 +212,8 @@ class ParallelWordLibrary:
         with ThreadPoolExecutor() as executor:
             executor.map(reload_file, modified_files)
 
-    def find_command(self, command):
+    def find_command(self, command, words=None):
+        """words为允许匹配的词库文件名集合，None表示全部词库"""
         start_time = time.time()
         results = []
         
@@ -230,7 +234,8 @@ class ParallelWordLibrary:
         with ThreadPoolExecutor() as executor:
             futures = {
                 executor.submit(query, lib): lib 
-                for lib in self._libraries.values()
+                for file_path, lib in list(self._libraries.items())
+                if words is None or os.path.basename(file_path) in words
             }
             
             for future in futures:
@@ -352,12 +357,175 @@ class QALibrary:
     def close(self):
         self._running = False
 
-async def process_reply(raw_reply_lines, cost, line, message, member_openid, group_openid, self, message_type, qa_lib):
-    """处理回复中的函数和变量"""
+# ====================== 渲染预算 ======================
+class RenderBudget:
+    """单条回复的渲染预算，回调与外层回复共用同一个预算
+
+    $调用创建的消息使用新的预算，但函数次数计入最初那条消息(root)
+    """
+    total_truncated = 0  # 进程内被截断的回复总数
+
+    # 未执行的函数，截断当前行时从这里切断
+    FUNCTION_PATTERN = re.compile(r'\$(?:全局变量|变量|复制|回调|调用) ')
+
+    def __init__(self, depth=0, root=None):
+        (self.max_output, self.max_expansions,
+         self.max_callback_depth, self.time_limit) = render_config()
+        self.deadline = time.monotonic() + self.time_limit
+        self.expansions = 0
+        self.depth = depth
+        self.root = root if root is not None else self
+        self.stopped = False
+        self.exceeded = defaultdict(int)  # 超出原因 -> 次数
+
+    def hit(self, reason, stop=True):
+        """记录一次超出预算，stop为True时停止后续渲染"""
+        if not self.exceeded:
+            RenderBudget.total_truncated += 1
+        self.exceeded[reason] += 1
+        if stop:
+            self.stopped = True
+
+    def timed_out(self):
+        if time.monotonic() > self.deadline:
+            self.hit('渲染超时')
+            return True
+        return False
+
+    def expand(self):
+        """执行函数前调用，超出次数或时间预算时返回False"""
+        if self.stopped or self.timed_out():
+            return False
+        if self.root.expansions >= self.max_expansions:
+            self.hit('函数次数')
+            return False
+        self.root.expansions += 1
+        return True
+
+    def remaining(self, used):
+        return max(self.max_output - used, 0)
+
+    def rendered_part(self, line):
+        """返回当前行中第一个未执行函数之前的部分"""
+        match = self.FUNCTION_PATTERN.search(line)
+        return line[:match.start()] if match else line
+
+# ====================== 性能分析 ======================
+class PipelineProfiler:
+    """按需开启的消息处理性能分析，关闭时只有一次active判断"""
+    def __init__(self):
+        (self.command, self.admins, self.max_messages,
+         self.max_seconds, self.output_dir) = profile_config()
+        self.active = False
+        self.messages_limit = self.max_messages
+        self.seconds_limit = self.max_seconds
+        self._profile = None
+        self._timer = None
+        self._messages = 0
+        self._started = 0
+        self._sessions = 0
+        self._stages = defaultdict(list)
+
+    def start(self, max_messages=None, max_seconds=None):
+        """开始采样，需在事件循环中调用，已在采样时返回False"""
+        if self.active:
+            return False
+        self.messages_limit = max_messages or self.max_messages
+        self.seconds_limit = max_seconds or self.max_seconds
+        self._messages = 0
+        self._stages = defaultdict(list)
+        self._started = time.time()
+        self._profile = cProfile.Profile()
+        self._timer = asyncio.get_running_loop().call_later(self.seconds_limit, self.stop)
+        self._sessions += 1
+        self.active = True
+        self._profile.enable()
+        print(f"{Colors.CYAN}性能分析已开启 | 消息数: {self.messages_limit} | 时长: {self.seconds_limit}s{Colors.END}")
+        return True
+
+    def session(self):
+        """返回当前采样会话的阶段统计，未采样时返回None
+
+        消息在开始处理时取得会话，之后只向该会话记录，避免写入已结束或新开始的会话
+        """
+        return self._stages if self.active else None
+
+    def message_done(self, stages):
+        if not self.active or stages is not self._stages:
+            return
+        self._messages += 1
+        if self._messages >= self.messages_limit:
+            self.stop()
+
+    def stop(self):
+        """停止采样并写入结果，返回结果文件路径"""
+        if not self.active:
+            return None
+        self._profile.disable()
+        self.active = False
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        # 在事件循环中取快照，写文件放到线程池中，避免阻塞所有账号
+        name = f"{time.strftime('profile-%Y%m%d-%H%M%S')}-{os.getpid()}-{self._sessions}"
+        base = os.path.join(self.output_dir, name)
+        stats = pstats.Stats(self._profile)
+        stages = {stage: list(costs) for stage, costs in self._stages.items()}
+        header = f"采样消息数: {self._messages} | 采样时长: {time.time() - self._started:.2f}s\n\n"
+        asyncio.get_running_loop().run_in_executor(None, self._write, base, stats, stages, header)
+        return base + ".txt"
+
+    def _write(self, base, stats, stages, header):
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            stats.dump_stats(base + ".prof")
+            with open(base + ".txt", "w", encoding="utf-8") as f:
+                f.write(header)
+                f.write("阶段耗时(ms): 次数 | 平均 | 最大 | 合计\n")
+                for stage, costs in stages.items():
+                    total = sum(costs) * 1000
+                    f.write(f"{stage}: {len(costs)} | {total / len(costs):.2f} | "
+                            f"{max(costs) * 1000:.2f} | {total:.2f}\n")
+                f.write("\n")
+                stats.stream = f
+                stats.sort_stats("cumulative").print_stats(50)
+            print(f"{Colors.CYAN}性能分析已完成: {base}.txt{Colors.END}")
+        except Exception as e:
+            print(f"{Colors.RED}性能分析写入失败: {e}{Colors.END}")
+
+async def profile_command(self, cmd, message_type, message, member_openid):
+    """管理员性能分析指令"""
+    args = cmd.split()[1:]
+    if args and args[0] == "停止":
+        path = profiler.stop()
+        answer_msg = f"性能分析已停止，结果: {path}" if path else "性能分析未开启"
+    else:
+        def bounded(index, upper):
+            # 只接受ASCII数字，并限制在1~upper之间
+            if len(args) <= index or not (args[index].isascii() and args[index].isdigit()):
+                return None
+            return min(max(int(args[index][:len(str(upper))]), 1), upper)
+
+        max_messages = bounded(0, 10000)
+        max_seconds = bounded(1, 3600)
+        if profiler.start(max_messages, max_seconds):
+            answer_msg = f"性能分析已开启: {profiler.messages_limit}条消息或{profiler.seconds_limit}秒"
+        else:
+            answer_msg = "性能分析正在进行中"
+    await answer_dealwith(self, answer_msg, "string", message_type, message, member_openid)
+
+async def process_reply(raw_reply_lines, cost, line, message, member_openid, group_openid, self, message_type, qa_lib, budget=None, timing=None):
+    """处理回复中的函数和变量，timing不为None时累计回调耗时"""
     params = {}  
     reply = ""
+    if budget is None:
+        budget = RenderBudget()
     
     for processed_line in raw_reply_lines:
+        if budget.stopped or budget.timed_out():
+            break
+
         if processed_line[1:2] == ":" or processed_line[1:2] == "=" or processed_line[1:3] == " =":
             replyline = processed_line[1:2]
             if processed_line[1:3] == " =":
@@ -373,21 +541,27 @@ async def process_reply(raw_reply_lines, cost, line, message, member_openid, gro
         if re.findall("\\$全局变量 (.*?) (.*?)\\$", processed_line):
             pattern = r'\$全局变量 (.*?) (.*?)\$'
             matches = re.findall(pattern, processed_line)
-            for match in matches:
+            for match in dict.fromkeys(matches):
+                if not budget.expand():
+                    break
                 qa_lib.public_params[match[0]] = match[1]
                 processed_line = processed_line.replace(f"$全局变量 {match[0]} {match[1]}$", "")
                 
         if re.findall("\\$变量 (.*?) (.*?)\\$", processed_line):
             pattern = r'\$变量 (.*?) (.*?)\$'
             matches = re.findall(pattern, processed_line)
-            for match in matches:
+            for match in dict.fromkeys(matches):
+                if not budget.expand():
+                    break
                 params[match[0]] = match[1]
                 processed_line = processed_line.replace(f"$变量 {match[0]} {match[1]}$", "")
                 
         if re.findall("\\$全局变量 (.*?)\\$", processed_line):
             pattern = r'\$全局变量 (.*?)\$'
             matches = re.findall(pattern, processed_line)
-            for match in matches:
+            for match in dict.fromkeys(matches):
+                if not budget.expand():
+                    break
                 match = match.strip()
                 if match in qa_lib.public_params:
                     b = qa_lib.public_params[match]
@@ -405,36 +579,87 @@ async def process_reply(raw_reply_lines, cost, line, message, member_openid, gro
         if re.findall("\$复制 (.*?) (.*?)\$", processed_line):
             pattern = r'\$复制 (.*?) (.*?)\$'
             matches = re.findall(pattern, processed_line)
-            for match in matches:
-                if match[1].isdigit():
-                    blank = match[0] * int(match[1])
-                    processed_line = processed_line.replace(f"$复制 {match[0]} {match[1]}$", blank)
+            for match in dict.fromkeys(matches):
+                if not budget.expand():
+                    break
+                if match[1].isascii() and match[1].isdigit():
+                    # 先按剩余字数限制次数，避免超大复制先分配内存
+                    token = f"$复制 {match[0]} {match[1]}$"
+                    occurrences = processed_line.count(token)
+                    # 超过9位的次数必然超出预算，不交给int()解析
+                    times = int(match[1]) if len(match[1]) <= 9 else budget.max_output + 1
+                    remaining = budget.remaining(len(reply) + len(processed_line) - len(token) * occurrences)
+                    unit = max(len(match[0]), 1)
+                    if unit * times * occurrences <= remaining:
+                        processed_line = processed_line.replace(token, match[0] * times)
+                    else:
+                        budget.hit('输出长度', stop=False)
+                        blank = match[0] * min(times, -(-remaining // unit))
+                        for _ in range(occurrences):
+                            piece = blank[:remaining]
+                            remaining -= len(piece)
+                            processed_line = processed_line.replace(token, piece, 1)
                     
         if re.findall("\$回调 (.*?)\$", processed_line):
             pattern = r'\$回调 (.*?)\$'
             matches = re.findall(pattern, processed_line)
-            for match in matches:
+            for match in dict.fromkeys(matches):
+                if not budget.expand():
+                    break
+                if budget.depth >= budget.max_callback_depth:
+                    # 超出深度的回调按空内容处理
+                    budget.hit('回调深度', stop=False)
+                    processed_line = processed_line.replace(f"$回调 {match}$", "")
+                    continue
                 message.content = '[内部]' + str(match)
                 call_back = True
-                call_back_answer = await message_dealwith(self, message, message_type, call_back)
+                # 回调内部不传timing，嵌套回调的耗时已包含在这里
+                if timing is not None:
+                    stage_start = time.perf_counter()
+                budget.depth += 1
+                try:
+                    call_back_answer = await message_dealwith(self, message, message_type, call_back, budget)
+                finally:
+                    budget.depth -= 1
+                    if timing is not None:
+                        timing['回调'] += time.perf_counter() - stage_start
                 if call_back_answer is None:
                     call_back_answer = ''
-                processed_line = processed_line.replace(f"$回调 {match}$", call_back_answer)
+                # 同一回调的结果会替换所有相同的函数，先按剩余字数截断
+                token = f"$回调 {match}$"
+                occurrences = processed_line.count(token)
+                remaining = budget.remaining(len(reply) + len(processed_line) - len(token) * occurrences)
+                if len(call_back_answer) * occurrences <= remaining:
+                    processed_line = processed_line.replace(token, call_back_answer)
+                else:
+                    budget.hit('输出长度', stop=False)
+                    for _ in range(occurrences):
+                        piece = call_back_answer[:remaining]
+                        remaining -= len(piece)
+                        processed_line = processed_line.replace(token, piece, 1)
                 
         if re.findall(r"\$调用", processed_line):
             matches = re.findall(r'\$调用 (?:(\d+) )?(.*?)\$', processed_line)
             for match in matches:
+                if not budget.expand():
+                    break
                 delay_str, content = match
-                processed_line = processed_line.replace(f"$调用 {delay_str+' ' if delay_str else ''}{content}$", "")
+                # 每个调用都会创建任务，逐个替换
+                processed_line = processed_line.replace(f"$调用 {delay_str+' ' if delay_str else ''}{content}$", "", 1)
+                if budget.depth >= budget.max_callback_depth:
+                    # 调用链超出深度时不再创建任务
+                    budget.hit('调用深度', stop=False)
+                    continue
                 
-                async def execute_call(msg_content=content, delay=delay_str):
+                # 调用创建的消息与当前消息共用函数次数
+                async def execute_call(msg_content=content, delay=delay_str, depth=budget.depth + 1, root=budget.root):
                     try:
                         if delay:
                             await asyncio.sleep(int(delay))
                         original_content = message.content
                         try:
                             message.content = msg_content
-                            await message_dealwith(self, message, message_type, False)
+                            await message_dealwith(self, message, message_type, False, depth=depth, root=root)
                         finally:
                             message.content = original_content
                     except Exception as e:
@@ -454,7 +679,18 @@ async def process_reply(raw_reply_lines, cost, line, message, member_openid, gro
         
         for var, val in variables.items():
             processed_line = processed_line.replace(var, val)
-        
+
+        # 超出预算时保留当前行已渲染的部分
+        if budget.stopped:
+            processed_line = budget.rendered_part(processed_line)
+
+        if budget.stopped or len(reply) + len(processed_line) > budget.max_output:
+            if len(reply) + len(processed_line) > budget.max_output:
+                processed_line = processed_line[:budget.remaining(len(reply))]
+                budget.hit('输出长度')
+            reply += processed_line
+            break
+
         reply += processed_line
     
     return reply
@@ -511,7 +747,21 @@ async def answer_dealwith(self, answer_msg, answer_type, message_type, message,
             )
 
 # ====================== 消息处理 ======================
-async def message_dealwith(self, message, message_type, call_back):
+async def message_dealwith(self, message, message_type, call_back, budget=None, depth=0, root=None):
+    # 回调和$调用创建的消息(root不为None)属于内部消息，不单独采样
+    stages = None if call_back or root is not None else profiler.session()
+    if stages is None:
+        return await _message_dealwith(self, message, message_type, call_back, budget, depth, root)
+
+    stage_start = time.perf_counter()
+    try:
+        return await _message_dealwith(self, message, message_type, call_back, budget, depth, root, stages)
+    finally:
+        stages['总计'].append(time.perf_counter() - stage_start)
+        profiler.message_done(stages)
+
+async def _message_dealwith(self, message, message_type, call_back, budget=None, depth=0, root=None, stages=None):
+    """stages为该消息所属的性能分析会话，内部消息不单独统计阶段耗时"""
     message_type_list = {
         'group': '群组',
         'channel': '频道',
@@ -544,13 +794,27 @@ async def message_dealwith(self, message, message_type, call_back):
         group_openid = message.author.id
         
     cmd = message.content.strip()
-    
-    results, total_cost = library.find_command(cmd)
+
+    if (not call_back and root is None and member_openid in profiler.admins
+            and cmd.split(' ', 1)[0] == profiler.command):
+        await profile_command(self, cmd, message_type, message, member_openid)
+        return
+
+    profiling = stages is not None
+    if profiling:
+        stage_start = time.perf_counter()
+    results, total_cost = library.find_command(cmd, self.words)
+    if profiling:
+        stages['查找'].append(time.perf_counter() - stage_start)
     
     if not results:
         return
     
     for result in results:
+        render_budget = budget if budget is not None else RenderBudget(depth, root)
+        timing = defaultdict(float) if profiling else None
+        if profiling:
+            stage_start = time.perf_counter()
         processed_reply = await process_reply(
             result['raw_reply'],
             result['cost'],
@@ -560,12 +824,27 @@ async def message_dealwith(self, message, message_type, call_back):
             group_openid,
             self, 
             message_type,
-            result['lib']
+            result['lib'],
+            render_budget,
+            timing
         )
+        if profiling:
+            # 渲染耗时不含回调，各阶段合计不超过总计
+            stages['渲染'].append(time.perf_counter() - stage_start - timing['回调'])
+            if timing['回调']:
+                stages['回调'].append(timing['回调'])
         if not call_back:
+            if render_budget.exceeded:
+                reasons = ', '.join(f"{k}x{v}" for k, v in render_budget.exceeded.items())
+                print(f"{Colors.RED}回复已截断 [{result['file']} 第{result['line']}行]: {reasons} | "
+                      f"累计截断: {RenderBudget.total_truncated}{Colors.END}")
             answer_msg = processed_reply.replace('%当前词库%', result['file'])
             if answer_msg.strip() != '':
+                if profiling:
+                    stage_start = time.perf_counter()
                 await answer_dealwith(self, answer_msg, answer_type, message_type, message, member_openid)
+                if profiling:
+                    stages['发送'].append(time.perf_counter() - stage_start)
                 print(f"{Colors.GREEN}回复消息: {answer_msg}{Colors.END}")
         else:
             return processed_reply
@@ -574,6 +853,10 @@ async def message_dealwith(self, message, message_type, call_back):
 
 # ====================== 主程序 ======================
 class MyClient(botpy.Client):
+    def __init__(self, *args, words=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.words = words
+
     async def on_group_at_message_create(self, message: GroupMessage):
         if '[内部]' not in message.content:
             await message_dealwith(self, message, "group", False)
@@ -590,14 +873,64 @@ class MyClient(botpy.Client):
         if '[内部]' not in message.content:
             await message_dealwith(self, message, "channel_friend", False)
         
+def load_accounts():
+    """读取多账号配置，未配置时回退到account_config的单个账号"""
+    accounts = accounts_config()
+    if not accounts:
+        appid, secret, sandbox = account_config()
+        accounts = [{"appid": appid, "secret": secret, "sandbox": sandbox}]
+
+    available = {f for f in os.listdir(library.dir_path) if f.endswith(".liq")}
+    loaded = []
+    for account in accounts:
+        words = account.get("words")
+        if words is not None:
+            words = set(words)
+            missing = words - available
+            if missing:
+                raise ValueError(f"[{account['appid']}] 词库不存在: {', '.join(sorted(missing))}")
+        loaded.append({
+            "appid": account["appid"],
+            "secret": account["secret"],
+            "sandbox": account.get("sandbox", 0) == 1,
+            "words": words
+        })
+    return loaded
+
+async def run_clients(clients):
+    """在同一个事件循环中运行所有账号"""
+    async def run_one(client, account):
+        # 单个账号出错不影响其他账号
+        try:
+            async with client:
+                await client.start(appid=account["appid"], secret=account["secret"])
+        except Exception as e:
+            print(f"{Colors.RED}[{account['appid']}] 账号运行失败: {e}{Colors.END}")
+
+    # kill -USR1 <pid> 开始性能分析
+    if hasattr(signal, "SIGUSR1"):
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, profiler.start)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    await asyncio.gather(*(run_one(client, account) for client, account in clients))
+
 if __name__ == "__main__":
     import Main
 else:
     print(f"{Colors.MAGENTA}正在装载词库...{Colors.END}")
     library = ParallelWordLibrary()
+    profiler = PipelineProfiler()
     intents = botpy.Intents.default()
-    sandbox_type = account_config()[2] == 1
-    if sandbox_type:
-        print(f"{Colors.YELLOW}沙箱模式已开启{Colors.END}")
-    client = MyClient(intents=intents, is_sandbox=sandbox_type)
-    client.run(appid=account_config()[0], secret=account_config()[1])
\ No newline at end of file
+    clients = []
+    for account in load_accounts():
+        if account["sandbox"]:
+            print(f"{Colors.YELLOW}[{account['appid']}] 沙箱模式已开启{Colors.END}")
+        client = MyClient(intents=intents, is_sandbox=account["sandbox"], words=account["words"])
+        clients.append((client, account))
+    print(f"{Colors.MAGENTA}已启动账号数: {len(clients)}{Colors.END}")
+    try:
+        clients[0][0].loop.run_until_complete(run_clients(clients))
+    except KeyboardInterrupt:
+        pass
\ No newline at end of file